@@ -20,13 +20,47 @@
 # places the file in the same directory as the parcels.
 # Once created, the directory can be served over http as a parcel repository.
 
+import argparse
 import hashlib
 import json
+import mmap
 import os
 import re
 import sys
 import tarfile
 import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+  # orjson is considerably faster than the json module, but is optional.
+  import orjson
+
+  def _loads(data):
+    return orjson.loads(data)
+
+  def _dumps(obj, pretty):
+    option = orjson.OPT_INDENT_2 if pretty else None
+    return orjson.dumps(obj, option=option).decode('UTF-8')
+except ImportError:
+  def _loads(data):
+    # json accepts UTF-8 encoded bytes directly, no need to decode first
+    return json.loads(data)
+
+  def _dumps(obj, pretty):
+    if pretty:
+      return json.dumps(obj, indent=4, separators=(',', ': '))
+    return json.dumps(obj, separators=(',', ':'))
+
+# Size of the reads tarfile makes from a parcel while scanning it
+_STREAM_BUFSIZE = 1 << 20
+
+# Freshly initialised SHA-1 state; copied for each parcel instead of looking
+# up and constructing a new hash object every time. Never updated itself.
+_SHA1 = hashlib.sha1()
+
+# <name>-<version>-<distro>.parcel, where the version may itself contain '-'
+_PARCEL_NAME_RE = re.compile(r"^(.*?)-(.*)-(.*?)$")
 
 def _get_parcel_dirname(parcel_name):
   """
@@ -34,8 +68,55 @@ def _get_parcel_dirname(parcel_name):
 
   eg: CDH-5.0.0-el6.parcel -> CDH-5.0.0
   """
-  parts = re.match(r"^(.*?)-(.*)-(.*?)$", parcel_name).groups()
-  return parts[0] + '-' + parts[1]
+  return '-'.join(_PARCEL_NAME_RE.match(parcel_name).group(1, 2))
+
+class _HashingReader(object):
+  """
+  File-like wrapper that feeds every byte read through it into a SHA-1.
+
+  This lets the tar reader and the hash share a single pass over the parcel.
+  """
+  def __init__(self, fp):
+    self.fp = fp
+    self.sha1 = _SHA1.copy()
+
+  def read(self, size=-1):
+    buf = self.fp.read(size)
+    self.sha1.update(buf)
+    return buf
+
+  def hexdigest(self):
+    """
+    Hash whatever has not been read yet and return the digest of the file.
+
+    The remainder is mapped into memory and handed to the hash in one call,
+    so it is hashed straight from the page cache without being copied. If it
+    cannot be mapped (too large for a 32-bit address space, or unsupported by
+    the filesystem), it is read in blocks instead.
+    """
+    pos = self.fp.tell()
+    size = os.fstat(self.fp.fileno()).st_size
+    if pos < size:
+      # Only map the tail; the offset must be a multiple of the granularity.
+      offset = pos - pos % mmap.ALLOCATIONGRANULARITY
+      try:
+        mm = mmap.mmap(self.fp.fileno(), size - offset,
+                       access=mmap.ACCESS_READ, offset=offset)
+      except (EnvironmentError, ValueError, OverflowError):
+        mm = None
+      if mm is None:
+        for block in iter(lambda: self.read(_STREAM_BUFSIZE), b''):
+          pass
+      else:
+        try:
+          if sys.version_info[0] < 3:
+            self.sha1.update(buffer(mm, pos - offset))
+          else:
+            with memoryview(mm) as view:
+              self.sha1.update(view[pos - offset:])
+        finally:
+          mm.close()
+    return self.sha1.hexdigest()
 
 def _safe_copy(key, src, dest):
   """
@@ -46,7 +127,111 @@ def _safe_copy(key, src, dest):
   if key in src:
     dest[key] = src[key]
 
-def make_manifest(path, timestamp=time.time()):
+def _read_members(fullpath, names):
+  """
+  Read members that cannot be extracted from a tar stream, such as links.
+
+  The archive is reopened for random access, which lets tarfile resolve hard
+  and symbolic links. Members that still cannot be read as a file are left
+  out of the result.
+
+  @param fullpath: The path of the parcel
+  @param names: The member names to read
+  @return: a dictionary of member name to contents
+  """
+  contents = {}
+  with tarfile.open(fullpath, 'r') as tar:
+    for name in names:
+      try:
+        member = tar.extractfile(name)
+      except (KeyError, tarfile.TarError):
+        # Dangling link
+        continue
+      if member is not None:
+        contents[name] = member.read()
+  return contents
+
+def _find_parcels(path):
+  """
+  List the names of the parcel files in a directory.
+
+  os.scandir (Python 3.5+) is used where available since it can tell files
+  from directories without an extra stat call per entry.
+  """
+  if not hasattr(os, 'scandir'):
+    return [f for f in os.listdir(path) if f.endswith('.parcel')]
+  return [e.name for e in os.scandir(path)
+          if e.name.endswith('.parcel') and e.is_file()]
+
+def _make_entry(path, parcel_name):
+  """
+  Build the manifest entry for a single parcel file.
+
+  @param path: The directory containing the parcel
+  @param parcel_name: The file name of the parcel
+  @return: the manifest entry as a dictionary, or None if the parcel's
+           metadata could not be read
+  """
+  print("Found parcel %s" % (parcel_name,))
+  entry = {}
+  entry['parcelName'] = parcel_name
+
+  fullpath = os.path.join(path, parcel_name)
+
+  dirname = _get_parcel_dirname(parcel_name)
+  # Member names in a tar archive always use '/', whatever the local OS.
+  json_name = dirname + '/meta/parcel.json'
+  notes_name = dirname + '/meta/release-notes.txt'
+
+  # Open the archive as a stream so the compressed data is read exactly
+  # once. Members can only be extracted while they are current, so read
+  # the metadata files as they go past and stop once both have been seen.
+  # The parcel's hash is computed from the same reads.
+  contents = {}
+  unread = []
+  # tarfile does its own buffering, so read the file unbuffered and let the
+  # stream pull large blocks rather than 10 KiB records.
+  with open(fullpath, 'rb', 0) as fp:
+    if hasattr(os, 'posix_fadvise'):
+      # The whole file is read front to back; let the kernel read ahead.
+      os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    reader = _HashingReader(fp)
+    with tarfile.open(mode='r|*', fileobj=reader,
+                      bufsize=_STREAM_BUFSIZE) as tar:
+      for member in tar:
+        if member.name in (json_name, notes_name):
+          if member.isfile():
+            contents[member.name] = tar.extractfile(member).read()
+          else:
+            # Links can't be resolved in stream mode, see below
+            unread.append(member.name)
+          if len(contents) + len(unread) == 2:
+            break
+    entry['hash'] = reader.hexdigest()
+
+  if unread:
+    contents.update(_read_members(fullpath, unread))
+
+  if json_name not in contents:
+    print("Skipping %s: parcel does not contain parcel.json" % (parcel_name,))
+    return None
+  try:
+    parcel = _loads(contents[json_name])
+  except:
+    print("Skipping %s: failed to parse parcel.json" % (parcel_name,))
+    return None
+  _safe_copy('depends', parcel, entry)
+  _safe_copy('replaces', parcel, entry)
+  _safe_copy('conflicts', parcel, entry)
+  _safe_copy('components', parcel, entry)
+
+  # No problem if there's no release notes
+  if notes_name in contents:
+    entry['releaseNotes'] = contents[notes_name].decode(encoding='UTF-8')
+
+  return entry
+
+def make_manifest(path, timestamp=time.time(), pretty=False):
   """
   Make a manifest.json document from the contents of a directory.
 
@@ -54,63 +239,72 @@ def make_manifest(path, timestamp=time.time()):
   in it, and then build a manifest from those files. Certain metadata will be
   extracted from the parcel and copied into the manifest.
 
+  Parcels are processed concurrently on a thread pool. Hashing and
+  decompression release the GIL, so this scales with the number of cores.
+
   @param path: The path of the directory to scan for parcels
   @param timestamp: Unix timestamp to place in manifest.json
+  @param pretty: Whether to indent the output for human readers. The compact
+                 form is smaller and faster to produce.
   @return: the manifest.json as a string
   """
   manifest = {}
   manifest['lastUpdated'] = int(timestamp * 1000)
   manifest['parcels'] = []
 
-  files = os.listdir(path)
-  for f in files:
-    if not f.endswith('.parcel'):
-      continue
-
-    print("Found parcel %s" % (f,))
-    entry = {}
-    entry['parcelName'] = f
+  files = _find_parcels(path)
+  if files:
+    pool = ThreadPool(min(len(files), cpu_count()))
+    try:
+      entries = pool.map(lambda f: _make_entry(path, f), files)
+    finally:
+      pool.close()
+      pool.join()
+    manifest['parcels'] = [e for e in entries if e is not None]
 
-    fullpath = os.path.join(path, f)
-
-    with open(fullpath, 'rb') as fp:
-      entry['hash'] = hashlib.sha1(fp.read()).hexdigest()
-
-    with tarfile.open(fullpath, 'r') as tar:
-      try:
-        json_member = tar.getmember(os.path.join(_get_parcel_dirname(f),
-                                    'meta', 'parcel.json'))
-      except KeyError:
-        print("Parcel does not contain parcel.json")
-        continue
-      try:
-        parcel = json.loads(tar.extractfile(json_member).read().decode(encoding='UTF-8'))
-      except:
-        print("Failed to parse parcel.json")
-        continue
-      _safe_copy('depends', parcel, entry)
-      _safe_copy('replaces', parcel, entry)
-      _safe_copy('conflicts', parcel, entry)
-      _safe_copy('components', parcel, entry)
+  return _dumps(manifest, pretty)
 
-      try:
-        notes_member = tar.getmember(os.path.join(_get_parcel_dirname(f),
-                                     'meta', 'release-notes.txt'))
-        entry['releaseNotes'] = tar.extractfile(notes_member).read().decode(encoding='UTF-8')
-      except KeyError:
-        # No problem if there's no release notes
-        pass
+def write_manifest(path, manifest):
+  """
+  Write a manifest.json document into a directory.
 
-    manifest['parcels'].append(entry)
+  The document is written to a temporary file and renamed into place, so
+  clients fetching manifest.json while it is being regenerated never see a
+  partial file. The replacement is atomic except on Python 2 on Windows,
+  where the old manifest has to be removed first.
 
-  return json.dumps(manifest, indent=4, separators=(',', ': '))
+  @param path: The directory to write manifest.json into
+  @param manifest: The manifest.json document, as returned by make_manifest
+  """
+  path_to_manifest = os.path.join(path, 'manifest.json')
+  # Per-process name so concurrent runs do not write to the same file.
+  tmp_path = '%s.%d.tmp' % (path_to_manifest, os.getpid())
+  try:
+    # Always UTF-8, whatever the locale; orjson does not escape non-ASCII.
+    with open(tmp_path, 'wb') as fp:
+      fp.write(manifest.encode('UTF-8'))
+    if hasattr(os, 'replace'):
+      os.replace(tmp_path, path_to_manifest)
+    else:
+      if os.name == 'nt' and os.path.exists(path_to_manifest):
+        # os.rename will not overwrite an existing file on Windows
+        os.remove(path_to_manifest)
+      os.rename(tmp_path, path_to_manifest)
+  except:
+    # Don't leave a stray file in a directory that is being served
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
 
 if __name__ == "__main__":
-  path = os.path.curdir
-  if len(sys.argv) > 1:
-    path = sys.argv[1]
+  parser = argparse.ArgumentParser(
+      description="Create a manifest.json for a directory of parcels.")
+  parser.add_argument('path', nargs='?', default=os.path.curdir,
+                      help="directory to scan for parcels")
+  parser.add_argument('--pretty', action='store_true',
+                      help="indent manifest.json for human readers")
+  args = parser.parse_args()
+  path = args.path
   print("Scanning directory: %s" % (path))
 
-  manifest = make_manifest(path)
-  with open(os.path.join(path, 'manifest.json'), 'w') as fp:
-    fp.write(manifest)
+  write_manifest(path, make_manifest(path, pretty=args.pretty))
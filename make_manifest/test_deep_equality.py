@@ -22,6 +22,13 @@
 
 import datetime, time, operator, types
 
+### CLOUDERA PATCH ###
+try:
+  _string_types = basestring
+except NameError:
+  _string_types = (str, bytes)
+### CLOUDERA PATCH ###
+
 default_fudge = datetime.timedelta(seconds=0, microseconds=0, days=0)
 
 def deep_eq(_v1, _v2, datetime_fudge=default_fudge, _assert=False):
@@ -143,11 +150,15 @@ def deep_eq(_v1, _v2, datetime_fudge=default_fudge, _assert=False):
   # guard against strings because they are iterable and their
   # elements yield iterables infinitely. 
   # I N C E P T I O N
-  for t in types.StringTypes:
-    if isinstance(_v1, t):
-      break
-  else:
-    if isinstance(_v1, types.DictType):
+  ### CLOUDERA PATCH ###
+  # types.StringTypes and types.DictType do not exist on python 3
+  #for t in types.StringTypes:
+  #  if isinstance(_v1, t):
+  #    break
+  #else:
+  #  if isinstance(_v1, types.DictType):
+  if not isinstance(_v1, _string_types):
+    if isinstance(_v1, dict):
       op = _deep_dict_eq
     else:
       try:
@@ -156,5 +167,6 @@ def deep_eq(_v1, _v2, datetime_fudge=default_fudge, _assert=False):
         c1, c2 = _v1, _v2
       else:
         op = _deep_iter_eq
+  ### CLOUDERA PATCH ###
   
   return op(c1, c2)
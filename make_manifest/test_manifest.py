@@ -16,12 +16,57 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import io
 import json
 import make_manifest
+import os
+import shutil
+import tarfile
+import tempfile
 import test_deep_equality
 import unittest
 
+PARCEL_JSON = json.dumps({'depends': 'CDH', 'components': []}).encode('UTF-8')
+
+def _sha1(path):
+  with open(path, 'rb') as fp:
+    return hashlib.sha1(fp.read()).hexdigest()
+
 class TestMakeManifest(unittest.TestCase):
+  def setUp(self):
+    self.repo = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.repo)
+
+  def _make_parcel(self, parcel_name, members, mode='w:gz'):
+    """
+    Write a parcel to the temporary repository.
+
+    @param members: (name, data) pairs for regular files, or
+                    (name, type, linkname) triples for other members such as
+                    links, relative to the parcel directory and added to the
+                    archive in order
+    @return: the full path of the parcel
+    """
+    dirname = make_manifest._get_parcel_dirname(parcel_name)
+    fullpath = os.path.join(self.repo, parcel_name)
+    with tarfile.open(fullpath, mode) as tar:
+      for member in members:
+        info = tarfile.TarInfo(dirname + '/' + member[0])
+        if len(member) == 2:
+          info.size = len(member[1])
+          tar.addfile(info, io.BytesIO(member[1]))
+        else:
+          info.type = member[1]
+          info.linkname = member[2]
+          tar.addfile(info)
+    return fullpath
+
+  def _manifest(self):
+    return json.loads(make_manifest.make_manifest(self.repo, 0))
+
   def test_make_manifest(self):
     manifest_json = make_manifest.make_manifest('test_artifacts', 0)
     with open('test_artifacts/expected.json') as fp:
@@ -30,5 +75,135 @@ class TestMakeManifest(unittest.TestCase):
       expected = json.loads(expected_json)
       test_deep_equality.deep_eq(manifest, expected, _assert=True)
 
+  def test_pretty_and_compact_output(self):
+    compact = make_manifest.make_manifest('test_artifacts', 0)
+    pretty = make_manifest.make_manifest('test_artifacts', 0, pretty=True)
+    self.assertEqual(json.loads(compact), json.loads(pretty))
+    # No newlines, indentation or padding after separators
+    self.assertFalse('\n' in compact)
+    self.assertFalse('": ' in compact)
+    self.assertFalse(', {' in compact)
+    self.assertTrue('\n  ' in pretty)
+
+  def test_hash_includes_data_after_metadata(self):
+    # Large enough that the tar stream stops well before the end of the file
+    fullpath = self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON),
+        ('meta/release-notes.txt', b'notes'),
+        ('lib/payload', os.urandom(3 << 20))])
+    parcels = self._manifest()['parcels']
+    self.assertEqual(1, len(parcels))
+    self.assertEqual(_sha1(fullpath), parcels[0]['hash'])
+    self.assertEqual('CDH', parcels[0]['depends'])
+    self.assertEqual('notes', parcels[0]['releaseNotes'])
+
+  def test_hash_when_mmap_fails(self):
+    fullpath = self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON),
+        ('lib/payload', os.urandom(3 << 20)),
+        ('meta/release-notes.txt', b'notes'),
+        ('lib/more', os.urandom(3 << 20))])
+    def fail(*args, **kwargs):
+      raise EnvironmentError("mmap not supported")
+    orig_mmap = make_manifest.mmap.mmap
+    make_manifest.mmap.mmap = fail
+    try:
+      parcels = self._manifest()['parcels']
+    finally:
+      make_manifest.mmap.mmap = orig_mmap
+    self.assertEqual(_sha1(fullpath), parcels[0]['hash'])
+
+  def test_parcel_without_release_notes(self):
+    fullpath = self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON),
+        ('lib/payload', os.urandom(1 << 16))])
+    parcels = self._manifest()['parcels']
+    self.assertEqual(1, len(parcels))
+    self.assertEqual(_sha1(fullpath), parcels[0]['hash'])
+    self.assertEqual('CDH', parcels[0]['depends'])
+    self.assertFalse('releaseNotes' in parcels[0])
+
+  def test_parcel_with_linked_metadata(self):
+    # GNU tar stores hardlinked files as link members, which a tar stream
+    # cannot extract
+    hardlinked = self._make_parcel('FOO-1.0-el6.parcel', [
+        ('share/parcel.json', PARCEL_JSON),
+        ('meta/parcel.json', tarfile.LNKTYPE, 'FOO-1.0/share/parcel.json'),
+        ('share/notes.txt', b'notes'),
+        ('meta/release-notes.txt', tarfile.SYMTYPE, '../share/notes.txt')])
+    regular = self._make_parcel('BAR-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON)])
+    parcels = dict((p['parcelName'], p) for p in self._manifest()['parcels'])
+    self.assertEqual(2, len(parcels))
+    foo = parcels['FOO-1.0-el6.parcel']
+    self.assertEqual(_sha1(hardlinked), foo['hash'])
+    self.assertEqual('CDH', foo['depends'])
+    self.assertEqual('notes', foo['releaseNotes'])
+    self.assertEqual(_sha1(regular), parcels['BAR-1.0-el6.parcel']['hash'])
+
+  def test_parcel_with_dangling_link_to_parcel_json(self):
+    self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', tarfile.SYMTYPE, '../share/missing.json')])
+    self.assertEqual([], self._manifest()['parcels'])
+
+  def test_parcel_json_not_a_file(self):
+    self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', tarfile.DIRTYPE, '')])
+    self.assertEqual([], self._manifest()['parcels'])
+
+  def test_parcel_without_parcel_json(self):
+    self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/release-notes.txt', b'notes')])
+    self.assertEqual([], self._manifest()['parcels'])
+
+  def test_parcel_with_bad_parcel_json(self):
+    self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', b'{not json')])
+    self.assertEqual([], self._manifest()['parcels'])
+
+  def test_uncompressed_parcel(self):
+    fullpath = self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON),
+        ('meta/release-notes.txt', b'notes'),
+        ('lib/payload', os.urandom(3 << 20))], mode='w')
+    parcels = self._manifest()['parcels']
+    self.assertEqual(_sha1(fullpath), parcels[0]['hash'])
+    self.assertEqual('notes', parcels[0]['releaseNotes'])
+
+  def test_non_ascii_release_notes(self):
+    notes = u'Fixes \u2013 and more'
+    self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON),
+        ('meta/release-notes.txt', notes.encode('UTF-8'))])
+    make_manifest.write_manifest(self.repo,
+                                 make_manifest.make_manifest(self.repo, 0))
+    with open(os.path.join(self.repo, 'manifest.json'), 'rb') as fp:
+      manifest = json.loads(fp.read().decode('UTF-8'))
+    self.assertEqual(notes, manifest['parcels'][0]['releaseNotes'])
+
+  def test_write_manifest_replaces_existing(self):
+    make_manifest.write_manifest(self.repo, '{"parcels":[]}')
+    make_manifest.write_manifest(self.repo, '{"parcels":[],"lastUpdated":0}')
+    self.assertEqual(['manifest.json'], os.listdir(self.repo))
+    with open(os.path.join(self.repo, 'manifest.json')) as fp:
+      self.assertEqual('{"parcels":[],"lastUpdated":0}', fp.read())
+
+  def test_write_manifest_failure_leaves_no_temp_file(self):
+    make_manifest.write_manifest(self.repo, '{"parcels":[]}')
+    # Not a string, so encoding it fails part way through the write
+    self.assertRaises(AttributeError, make_manifest.write_manifest,
+                      self.repo, None)
+    self.assertEqual(['manifest.json'], os.listdir(self.repo))
+    with open(os.path.join(self.repo, 'manifest.json')) as fp:
+      self.assertEqual('{"parcels":[]}', fp.read())
+
+  def test_bz2_parcel(self):
+    fullpath = self._make_parcel('FOO-1.0-el6.parcel', [
+        ('meta/parcel.json', PARCEL_JSON),
+        ('meta/release-notes.txt', b'notes')], mode='w:bz2')
+    parcels = self._manifest()['parcels']
+    self.assertEqual(_sha1(fullpath), parcels[0]['hash'])
+    self.assertEqual('notes', parcels[0]['releaseNotes'])
+
 if __name__ == "__main__":
   unittest.main()
\ No newline at end of file